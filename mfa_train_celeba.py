@@ -36,7 +36,7 @@ def main(argv):
     print('Running MFA Teaining. Output folder is', output_folder)
     os.makedirs(output_folder, exist_ok=True)
 
-    if not os.path.isfile(os.path.join(output_folder, 'final_gmm.pkl')):
+    if not mfa.model_file_exists(os.path.join(output_folder, 'final_gmm')):
         gmm_model = mfa_sgd_training.train(num_components=args.num_components, latent_dimension=args.latent_dimension,
                          out_folder=output_folder, image_shape=image_shape, init_method='km',
                          image_provider=image_provider, batch_size=batch_size, test_size=test_size,
@@ -63,7 +63,7 @@ def main(argv):
                                                                      list_file=list_file)
 
             comp_out_folder = os.path.join(output_folder, 'hierarchic_model', 'comp_{}'.format(comp_num))
-            if os.path.isfile(os.path.join(comp_out_folder, 'final_gmm.pkl')):
+            if mfa.model_file_exists(os.path.join(comp_out_folder, 'final_gmm')):
                 print('Skipping component {} - already learned.'.format(comp_num))
             else:
                 os.makedirs(comp_out_folder, exist_ok=True)
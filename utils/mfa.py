@@ -1,11 +1,20 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+import scipy.linalg
+import scipy.linalg.blas
+import scipy.special
+import importlib.util
 import pickle
 import math
+import collections.abc
 import os
+import sys
 import time
-import multiprocessing
+import types
+from concurrent.futures import ThreadPoolExecutor
+# numba and cupy are optional and slow to import, so they are only imported when their backend is used
+# (see _import_numba and _import_cupy)
+numba = None
+cupy = None
 
 class Timer(object):
     def __init__(self, name='Operation'):
@@ -18,6 +27,265 @@ class Timer(object):
         print('%s took: %s sec' % (self.name, time.time() - self.tstart))
 
 
+# The numba kernels split the rows of X into tasks of this many rows, so the scratch arrays are allocated once per task
+_ROWS_PER_TASK = 256
+
+
+def _mahalanobis_rows(X, mu, W, invD, out):
+    """
+    Fused per-row (x-mu)' @ iSigma @ (x-mu) = |(x-mu) * sqrt(invD)|^2 - |W @ (x-mu)|^2
+    where W = inv(L) @ A_scaled' is [l, d] (L is the lower Cholesky factor of the l x l capacitance matrix).
+    Compiled with numba (see _import_numba).
+    """
+    N, d = X.shape
+    l = W.shape[0]
+    for t in numba.prange((N + _ROWS_PER_TASK - 1) // _ROWS_PER_TASK):
+        y = np.empty(l)
+        for i in range(t * _ROWS_PER_TASK, min(N, (t + 1) * _ROWS_PER_TASK)):
+            y[:] = 0.0
+            s1 = 0.0
+            for j in range(d):
+                x_c = X[i, j] - mu[j]
+                s1 += x_c * x_c * invD[j]
+                for m in range(l):
+                    y[m] += x_c * W[m, j]
+            s2 = 0.0
+            for m in range(l):
+                s2 += y[m] * y[m]
+            out[i] = s1 - s2
+
+
+def _mixture_mahalanobis_rows(X, mu, W, invD, out):
+    """
+    Same as _mahalanobis_rows, but for all K components in a single pass over each row of X:
+    mu, invD: [K, d], W: [d, K*l] (all the components' W.T side by side), out: [N, K]
+    """
+    N, d = X.shape
+    K = mu.shape[0]
+    l = W.shape[1] // K
+    for t in numba.prange((N + _ROWS_PER_TASK - 1) // _ROWS_PER_TASK):
+        y = np.empty(K*l)
+        s1 = np.empty(K)
+        for i in range(t * _ROWS_PER_TASK, min(N, (t + 1) * _ROWS_PER_TASK)):
+            y[:] = 0.0
+            s1[:] = 0.0
+            for j in range(d):
+                x = X[i, j]
+                for k in range(K):
+                    x_c = x - mu[k, j]
+                    s1[k] += x_c * x_c * invD[k, j]
+                    for m in range(l):
+                        y[k*l + m] += x_c * W[j, k*l + m]
+            for k in range(K):
+                s2 = 0.0
+                for m in range(l):
+                    s2 += y[k*l + m] * y[k*l + m]
+                out[i, k] = s1[k] - s2
+
+
+# Source template of _mixture_mahalanobis_rows specialized for a fixed latent dimension l:
+# the loop over l is unrolled into l scalar accumulators (y0, y1, ...) that the compiler can keep in registers.
+# The accumulators hold a single component, so each row of X is streamed once per component (from cache).
+_SPECIALIZED_KERNEL_TEMPLATE = """import numba
+
+
+def mixture_mahalanobis_rows_l{l}(X, mu, W, invD, out):
+    N, d = X.shape
+    K = mu.shape[0]
+    for i in numba.prange(N):
+        for k in range(K):
+            s1 = 0.0
+{init}
+            for j in range(d):
+                x_c = X[i, j] - mu[k, j]
+                s1 += x_c * x_c * invD[k, j]
+{accumulate}
+            out[i, k] = s1 - ({reduce})
+"""
+# Larger latent dimensions use the generic kernel (too many accumulators to keep in registers)
+_MAX_SPECIALIZED_L = 16
+_specialized_kernels = {}
+
+
+def _generated_kernels_dir():
+    """
+    The generated kernels are written as modules (so that numba can cache their compiled code on disk) under numba's
+    cache directory (NUMBA_CACHE_DIR) if it is set, otherwise under the user's cache directory - not into the package
+    """
+    cache_dir = (numba.config.CACHE_DIR or os.environ.get('XDG_CACHE_HOME') or
+                 os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_dir, 'mfa_kernels')
+
+
+def _load_generated_module(name, source):
+    """
+    Write source to <_generated_kernels_dir()>/<name>.py (unless it is already there) and import it
+    An unchanged file is not re-written, as numba's disk cache is invalidated by the source file time stamp
+    """
+    kernels_dir = _generated_kernels_dir()
+    file_name = os.path.join(kernels_dir, name + '.py')
+    if os.path.isfile(file_name):
+        with open(file_name) as f:
+            if f.read() == source:
+                source = None
+    if source is not None:
+        os.makedirs(kernels_dir, exist_ok=True)
+        # Write and rename, so that concurrent processes never import a partially written file
+        temp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(temp_file_name, 'w') as f:
+            f.write(source)
+        os.replace(temp_file_name, file_name)
+    module_name = '_mfa_kernels_' + name
+    spec = importlib.util.spec_from_file_location(module_name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    # numba's disk cache re-imports the module by name when it loads a cached kernel
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _get_specialized_mixture_kernel(l):
+    """
+    Generate (once per l) and compile a mixture Mahalanobis kernel for a fixed latent dimension l
+    The compiled kernel is cached on disk like the other kernels. If the generated module cannot be written, the source
+    is exec'ed instead - such a kernel cannot be cached, so it is compiled again (~1 sec) in every process.
+    """
+    if l not in _specialized_kernels:
+        name = 'mixture_mahalanobis_rows_l{}'.format(l)
+        source = _SPECIALIZED_KERNEL_TEMPLATE.format(
+            l=l,
+            init='\n'.join(['            y{} = 0.0'.format(m) for m in range(l)]),
+            accumulate='\n'.join(['                y{0} += x_c * W[j, k*{1} + {0}]'.format(m, l) for m in range(l)]),
+            reduce=' + '.join(['y{0} * y{0}'.format(m) for m in range(l)]))
+        try:
+            kernel, cache = getattr(_load_generated_module(name, source), name), True
+        except OSError:
+            namespace = {}
+            exec(source, namespace)
+            kernel, cache = namespace[name], False
+        _specialized_kernels[l] = numba.njit(nogil=True, parallel=True, fastmath=True, cache=cache)(kernel)
+    return _specialized_kernels[l]
+
+
+def _renamed(func, name):
+    """
+    A copy of func under another name - numba's disk cache is keyed by the function name (not by the compile options),
+    so each compiled variant of the same function needs its own name
+    """
+    func_copy = types.FunctionType(func.__code__, func.__globals__, name)
+    func_copy.__qualname__ = name
+    return func_copy
+
+
+def _import_numba():
+    """
+    Import numba and wrap the kernels, on first use (raises ImportError if numba is not installed)
+    """
+    global numba, _mixture_mahalanobis_kernel, _mahalanobis_kernel, _mahalanobis_kernel_serial
+    if numba is None:
+        import numba as numba_module
+        _mixture_mahalanobis_kernel = numba_module.njit(nogil=True, parallel=True, fastmath=True, cache=True)(
+            _mixture_mahalanobis_rows)
+        # The parallel version splits the rows between threads, the serial one is for calling from multiple threads
+        _mahalanobis_kernel = numba_module.njit(nogil=True, parallel=True, fastmath=True, cache=True)(_mahalanobis_rows)
+        _mahalanobis_kernel_serial = numba_module.njit(nogil=True, fastmath=True, cache=True)(
+            _renamed(_mahalanobis_rows, '_mahalanobis_rows_serial'))
+        numba = numba_module
+
+
+def _import_cupy():
+    """
+    Import cupy on first use (raises ImportError if cupy is not installed)
+    """
+    global cupy
+    if cupy is None:
+        import cupy as cupy_module
+        cupy = cupy_module
+
+
+def _mahalanobis_distances(X, mu, W, invD, use_numba=False, parallel=True):
+    if use_numba:
+        _import_numba()
+        m_d = np.empty(X.shape[0])
+        kernel = _mahalanobis_kernel if parallel else _mahalanobis_kernel_serial
+        kernel(X, mu, W, invD, m_d)
+        return m_d
+    X_c = X - mu
+    Z = X_c @ W.T
+    return np.einsum('ij,ij->i', X_c, X_c * invD) - np.einsum('ij,ij->i', Z, Z)
+
+
+def model_file_exists(file_name):
+    """
+    Check if a model was saved under file_name (as .npz or as a legacy .pkl file)
+    """
+    return os.path.isfile(file_name+'.npz') or os.path.isfile(file_name+'.pkl')
+
+
+_COMPONENT_KEYS = ('A', 'D', 'mu', 'pi')
+
+
+class _ComponentView(collections.abc.MutableMapping):
+    """
+    Dict-like {'A': ..., 'D': ..., 'mu': ..., 'pi': ...} view of component k - reads and writes go to the model arrays
+    """
+    def __init__(self, model, k):
+        self._model = model
+        self._k = k
+
+    def __getitem__(self, key):
+        if key not in _COMPONENT_KEYS:
+            raise KeyError(key)
+        return getattr(self._model, key)[self._k]
+
+    def __setitem__(self, key, value):
+        if key not in _COMPONENT_KEYS:
+            raise KeyError('MFA components only have the parameters {}, got {}'.format(_COMPONENT_KEYS, key))
+        getattr(self._model, key)[self._k] = value
+        # A change of pi is detected by _prepare_component_cache itself
+        if key != 'pi':
+            self._model._reset_component_cache()
+
+    def __delitem__(self, key):
+        raise TypeError('MFA component parameters cannot be deleted')
+
+    def __iter__(self):
+        return iter(_COMPONENT_KEYS)
+
+    def __len__(self):
+        return len(_COMPONENT_KEYS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _ComponentsView(collections.abc.Mapping):
+    """
+    Dict-like {k: component view} access to the components of an MFA model (see MFA.components)
+    """
+    def __init__(self, model):
+        self._model = model
+
+    def __getitem__(self, k):
+        if not isinstance(k, (int, np.integer)) or not 0 <= k < len(self):
+            raise KeyError(k)
+        return _ComponentView(self._model, k)
+
+    def __setitem__(self, k, component):
+        component_view = self[k]
+        for key in _COMPONENT_KEYS:
+            component_view[key] = component[key]
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return self._model.pi.size
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class MFA:
     """
     Gaussian Mixture Model with optimization for High-dimensional Data
@@ -31,170 +299,318 @@ class MFA:
     Note: The main idea is similar to tensorflow MultivariateNormalDiagPlusLowRank, except that TF
         decomposes the scale matrix A itself as low-rank plus diagonal.
     """
-    def __init__(self, components=None):
-        self.components = components
+    def __init__(self, components=None, seed=None, dtype=np.float64, backend='numpy'):
+        assert backend in ['numpy', 'numba', 'cupy']
+        if backend == 'numba':
+            _import_numba()
+        elif backend == 'cupy':
+            _import_cupy()
         self.eps = 1e-16
         self.max_l = 8
+        # Type that X is read as for the log-probabilities (np.float32 halves its memory traffic). The products are
+        # accumulated in float64 in all backends: in float32, the Woodbury form (and the expanded quadratic form of the
+        # NumPy path) subtract large, nearly equal terms, which loses most of the precision at high d.
+        assert np.dtype(dtype) in [np.float32, np.float64]
+        self.dtype = np.dtype(dtype)
+        # Number of rows processed together in the NumPy log-probability path (the block should fit in L2 cache)
+        self.block_size = 1024
+        # The batched log-probability computation: 'numpy' (blocked BLAS), 'numba' (fused kernel) or 'cupy' (GPU)
+        self.backend = backend
+        self.rng = np.random.default_rng(seed)
+        # The model parameters are stored as struct-of-arrays: A [K, d, l], D [K, d], mu [K, d], pi [K]
+        self.components = components
+
+    @property
+    def components(self):
+        """
+        Legacy dict-of-dicts view of the parameters: {k: {'A': ..., 'D': ..., 'mu': ..., 'pi': ...}}
+        The view is created lazily per component and item assignments (e.g. components[k]['pi'] = p) write through to
+        the model arrays. In-place changes of the returned A, D or mu arrays themselves (e.g. c = components[k]['A'];
+        c *= 2) are not detected and leave the cached W and batched params stale - assign the item, or call set_params.
+        """
+        if self.A is None:
+            return None
+        return _ComponentsView(self)
+
+    @components.setter
+    def components(self, components):
+        if components:
+            comps = [components[k] for k in range(len(components))]
+            self.set_params(A=np.stack([c['A'] for c in comps]), D=np.stack([c['D'] for c in comps]),
+                            mu=np.stack([c['mu'] for c in comps]), pi=np.array([c['pi'] for c in comps]))
+        else:
+            self.set_params(None, None, None, None)
+
+    def set_params(self, A, D, mu, pi):
+        """
+        Set the parameters: A [K, d, l], D [K, d], mu [K, d], pi [K]
+        pi may later be modified in place (the cache detects it), but in-place edits of self.A, self.D or self.mu leave
+        the cached calculations (W, c_factor, the batched params) stale - call set_params again after changing them
+        """
+        self.A, self.D, self.mu, self.pi = A, D, mu, pi
+        self._reset_component_cache()
+
+    def _reset_component_cache(self):
+        # Cached calculations (see _prepare_component_cache)
+        self.A_scaled = None
+        self.L = None
+        self.W = None
+        self.c_factor = None
+        self.pi_c_factor = None
+        self._cached_pi = None
+        self._batched_params = None
 
     def randomize_params(self, num_components, dim=2, low_rank_scale=0.1, noise_variance=0.01, mu_range=0.8,
                          isotropic_noise=False):
         # l is the smaller dimension of the non-square matrices. Typically l << dim
         l = min(self.max_l, dim)
         d = dim
+        K = num_components
 
         # Create the component selection probability vector
-        pi = np.random.uniform(0.2, 1.0, num_components)
+        pi = self.rng.uniform(0.2, 1.0, K)
         pi = np.power(pi, 2)
         pi /= np.sum(pi)
 
         # Create the component parameters
-        self.components = {}
-        for i in range(num_components):
-            # The diagonal component
-            if isotropic_noise:
-                D = np.random.uniform(low=noise_variance / 10.0, high=noise_variance) * np.ones(size=[d])
-            else:
-                D = np.random.uniform(low=noise_variance / 10.0, high=noise_variance, size=[d])
-            # The rectangular scale matrix
-            A = np.random.normal(scale=low_rank_scale, size=[d, l])
-            mu = np.random.uniform(-mu_range, mu_range, dim)
-            self.components[i] = {'D': D, 'A': A, 'mu': mu, 'pi': pi[i]}
+        # The diagonal component
+        if isotropic_noise:
+            D = self.rng.uniform(low=noise_variance / 10.0, high=noise_variance, size=[K, 1]) * np.ones([K, d])
+        else:
+            D = self.rng.uniform(low=noise_variance / 10.0, high=noise_variance, size=[K, d])
+        # The rectangular scale matrices
+        A = self.rng.normal(scale=low_rank_scale, size=[K, d, l])
+        mu = self.rng.uniform(-mu_range, mu_range, [K, d])
+        self.set_params(A, D, mu, pi)
+        self._prepare_component_cache()
 
     @staticmethod
-    def _draw_from_component(num_samples, c, add_noise=True):
+    def _draw_from_component(num_samples, c, add_noise=True, rng=None):
+        rng = rng or np.random.default_rng()
         d, l= c['A'].shape
-        z_l = np.random.normal(size=[num_samples, l])
+        z_l = rng.standard_normal(size=[num_samples, l])
         # z_d @ np.diag(D) = z_d * D (element-wise multiply with broadcast) - column j of z_d is multiplied by Dj
         X = z_l @ c['A'].T + c['mu'].T
         if add_noise:
-            z_d = np.random.normal(size=[num_samples, d])
+            z_d = rng.standard_normal(size=[num_samples, d])
             X += z_d * np.sqrt(c['D'])
         return X
 
     def draw_samples(self, num_samples, add_noise=True):
-        pi = [c['pi'] for c in self.components.values()]
+        pi = self.pi.copy()
         # Fix numeric issue of pi not summing exactly to 1 (tensorflow softmax implementation?)
-        sp = sum(pi)
+        sp = np.sum(pi)
         if not sp == 1.0:
             assert abs(sp-1.0) < 1e-5
-            max_comp = pi.index(max(pi))
-            pi[max_comp] -= (sp-1.0)
+            pi[np.argmax(pi)] -= (sp-1.0)
 
         # Choose components and then sample relevant points from each components
-        samples = np.zeros((num_samples, self.components[0]['mu'].size), dtype=float)
-        s_k = np.random.choice(len(pi), p=pi, size=num_samples)
-        for k, c in self.components.items():
-            s_k_i = (s_k == k)
-            samples[s_k_i, :] = MFA._draw_from_component(sum(s_k_i), c, add_noise=add_noise)
-        return samples
+        # The random sources for all samples are drawn at once. The samples are generated ordered by component, so each
+        # component writes a contiguous block of rows, and are then permuted back to the random component order.
+        K, d, l = self.A.shape
+        s_k = self.rng.choice(K, p=pi, size=num_samples)
+        order = np.argsort(s_k, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(s_k, minlength=K))])
+        sorted_samples = np.empty([num_samples, d])
+        # The noise is drawn directly into the output rows and A @ z_l is accumulated onto them by gemm
+        # (a C-contiguous block of rows is passed as its Fortran-contiguous transpose), so no [N, d] temporaries
+        z_l = self.rng.standard_normal([num_samples, l])
+        if add_noise:
+            self.rng.standard_normal(out=sorted_samples)
+        gemm = scipy.linalg.blas.get_blas_funcs('gemm', dtype=sorted_samples.dtype)
+        for k in range(K):
+            b, e = offsets[k], offsets[k+1]
+            if b == e:
+                continue
+            block = sorted_samples[b:e]
+            if add_noise:
+                block *= np.sqrt(self.D[k])
+                block += self.mu[k]
+            else:
+                block[:] = self.mu[k]
+            gemm(1.0, self.A[k].T, z_l[b:e].T, beta=1.0, c=block.T, trans_a=1, overwrite_c=True)
+        inverse_order = np.empty_like(order)
+        inverse_order[order] = np.arange(num_samples)
+        return np.take(sorted_samples, inverse_order, axis=0)
 
     @staticmethod
-    def _get_component_log_probs_task(task):
-        c = task['c']
-        X = task['X']
-        assert len(X.shape) == 2 and X.shape[1] == c['A'].shape[0]
-
-        d, l = c['A'].shape
-        invD = np.power(c['D'], -1.0).reshape([d, 1])
-
-        # Calculate the inverse and determinant of sigma from the raw components using Woodbury's method
-        IPiDP = np.eye(l) + c['A'].T @ (c['A'] * invD)
-
-        # Note: inverse sigma calculation is fast, but takes O(d^2) memory
-        # It should be possible to optimize (x-mu) @ iSigma_fast @ (x-mu)' directly
-        inv_sigma1 = c['A'].T * invD.T
-        inv_sigma2 = (np.linalg.inv(IPiDP) @ c['A'].T * invD.T).T
-
-        # Calculate the determinant using the Matrix Determinant Lemma
-        # See https://en.wikipedia.org/wiki/Matrix_determinant_lemma#Generalization
-        log_dSigma = np.log(np.linalg.det(IPiDP)) + np.sum(np.log(c['D']))
-        c_factor = d*np.log(2*np.pi) + log_dSigma
-
-        # Calculate the log likelihood
-        # The below formula was devised (by rearranging the products) to avoid multiplication by a (d x d) matrix
-        X_c = X - c['mu']
-        m_d = np.sum(X_c * (X_c * invD.T - (X_c @ inv_sigma2) @ inv_sigma1), axis=1)
-        return task['comp_num'], np.log(c['pi']) - 0.5*(m_d + c_factor)
-
-
-    def _get_component_log_probs(self, X, k):
-        # TODO: Should add c['pi']
-        c = self.components[k]
-        assert len(X.shape) == 2 and X.shape[1] == c['A'].shape[0]
-
-        d, l = c['A'].shape
-        invD = np.power(c['D'], -1.0).reshape([d, 1])
+    def _get_component_log_probs_task(mu, W, invD, c_factor, X, use_numba):
+        """
+        Component log probabilities from the cached per-component calculations (see _prepare_component_cache)
+        """
+        assert len(X.shape) == 2 and X.shape[1] == W.shape[1]
+        # The task runs in a worker thread, so use the serial numba kernel (if selected)
+        m_d = _mahalanobis_distances(X, mu, W, invD, use_numba, parallel=False)
+        return -0.5*(m_d + c_factor)
 
-        # Cache some calculations (that do not depend on x) for later re-use
-        if 'c_factor' not in c.keys():
+    def _prepare_component_cache(self):
+        """
+        Cache some calculations (that do not depend on x) for all components, for later re-use
+        The mixing coefficients are folded into pi_c_factor, which is re-calculated (on its own) if pi was changed
+        """
+        if self.W is None:
+            K, d, l = self.A.shape
+            invD = np.power(self.D, -1.0)
 
             # Calculate the inverse and determinant of sigma from the raw components using Woodbury's method
-            IPiDP = np.eye(l) + c['A'].T @ (c['A'] * invD)
-
-            # Note: inverse sigma calculation is fast, but takes O(d^2) memory
-            # It should be possible to optimize (x-mu) @ iSigma_fast @ (x-mu)' directly
-            c['inv_sigma1'] = c['A'].T * invD.T
-            c['inv_sigma2'] = (np.linalg.inv(IPiDP) @ c['A'].T * invD.T).T
+            # Only the Cholesky factor of the small (l x l) capacitance matrix is needed:
+            # (x-mu)' @ iSigma @ (x-mu) = |(x-mu) * sqrt(invD)|^2 - |W @ (x-mu)|^2, where W = inv(L) @ A_scaled'
+            self.A_scaled = self.A * invD[:, :, np.newaxis]
+            self.L = np.linalg.cholesky(np.eye(l) + np.transpose(self.A, [0, 2, 1]) @ self.A_scaled)
+            self.W = np.stack([scipy.linalg.solve_triangular(self.L[k], self.A_scaled[k].T, lower=True)
+                               for k in range(K)])
 
             # Calculate the determinant using the Matrix Determinant Lemma
             # See https://en.wikipedia.org/wiki/Matrix_determinant_lemma#Generalization
-            log_dSigma = np.log(np.linalg.det(IPiDP)) + np.sum(np.log(c['D']))
+            log_dSigma = (2.0*np.sum(np.log(np.diagonal(self.L, axis1=1, axis2=2)), axis=1) +
+                          np.sum(np.log(self.D), axis=1))
+
+            self.c_factor = d*np.log(2*np.pi) + log_dSigma
+            self._cached_pi = None
+            self._batched_params = None
+
+        if not np.array_equal(self._cached_pi, self.pi):
+            # -0.5 * (m_d + pi_c_factor) directly gives log(pi) + log(N(x; mu, Sigma))
+            self.pi_c_factor = self.c_factor - 2.0*np.log(self.pi)
+            self._cached_pi = self.pi.copy()
 
-            c['c_factor'] = d*np.log(2*np.pi) + log_dSigma
-            self.components[k] = c
+    def _get_component_log_probs(self, X, k):
+        self._prepare_component_cache()
+        assert len(X.shape) == 2 and X.shape[1] == self.A.shape[1]
+        invD = np.power(self.D[k], -1.0)
 
         # Calculate the log likelihood
-        # The below formula was devised (by rearranging the products) to avoid multiplication by a (d x d) matrix
-        X_c = X - c['mu']
-        m_d = np.sum(X_c * (X_c * invD.T - (X_c @ c['inv_sigma2']) @ c['inv_sigma1']), axis=1)
-        return -0.5 * (m_d + c['c_factor'])
+        m_d = _mahalanobis_distances(X, self.mu[k], self.W[k], invD, use_numba=self.backend == 'numba')
+        return -0.5 * (m_d + self.c_factor[k])
 
-    # Based on http://bayesjumping.net/log-sum-exp-trick/
+    def _prepare_batched_params(self):
+        """
+        Arrange the cached calculations so that all K components are evaluated together:
+        - W: [d, K*l] - all the W.T = A_scaled @ inv(L).T matrices side by side (a single GEMM for all components)
+        - mu_W: [K*l] - the matching mu @ W.T offsets
+        - invD, mu_invD: [K, d] - the inverse noise variances and mu * invD
+        - mu_invD_mu: [K]
+        With the cupy backend, these arrays are also uploaded to the GPU (under 'device')
+        """
+        self._prepare_component_cache()
+        if self._batched_params is not None:
+            return self._batched_params
+        K, l, d = self.W.shape
+        self._batched_params = {
+            'W': np.ascontiguousarray(np.transpose(self.W, [2, 0, 1]).reshape([d, K*l])),
+            'mu_W': np.einsum('kld,kd->kl', self.W, self.mu).reshape([K*l]),
+            'invD': np.power(self.D, -1.0),
+            'mu_invD': self.mu / self.D,
+            'mu_invD_mu': np.sum(self.mu * self.mu / self.D, axis=1)}
+        if self.backend == 'cupy':
+            _import_cupy()
+            self._batched_params['device'] = {name: cupy.asarray(self._batched_params[name])
+                                              for name in ['W', 'mu_W', 'invD', 'mu_invD']}
+        return self._batched_params
+
+    # See http://bayesjumping.net/log-sum-exp-trick/ (scipy implements the same max-shifted reduction)
     @staticmethod
     def _log_sum_exp(ns):
-        max_vals = np.max(ns, axis=1, keepdims=True)
-        sum_of_exp = np.sum(np.exp(ns - max_vals), axis=1, keepdims=True)
-        return max_vals + np.log(sum_of_exp)
+        return scipy.special.logsumexp(ns, axis=1, keepdims=True)
 
     def _rearrange_input(self, samples):
         """
         Input should be either a single data point of size d or a batch of m vectors i.e. size [m, d]
         """
-        d = next(iter(self.components.values()))['A'].shape[0]
+        d = self.mu.shape[1]
         if len(samples.shape) == 2:
             assert samples.shape[1] == d
             return samples
         assert samples.size == d
         return np.reshape(samples, [1, d])
 
-    def _get_components_log_probabilities_multithreaded(self, samples):
-        print('_get_components_log_probabilities - multhreaded start')
+    def _get_components_log_probabilities_multithreaded(self, samples, min_problem_size=1e6):
         X = self._rearrange_input(samples)
-        components_log_probs = np.zeros([X.shape[0], len(self.components)], dtype=float)
-        pool = multiprocessing.Pool(8)
-        comonent_tasks = []
-        for i in range(len(self.components)):
-            comonent_tasks.append({'comp_num': i,
-                                   'c': self.components[i],
-                                   'X': X})
-        comp_results = pool.map(MFA._get_component_log_probs_task, comonent_tasks)
-        for comp_num, comp_ll in comp_results:
-            components_log_probs[:, comp_num] = comp_ll
+        if X.size < min_problem_size:
+            # Not worth the threading overhead
+            return self._get_components_log_probabilities(X)
+        print('_get_components_log_probabilities - multhreaded start')
+        K = self.pi.size
+        components_log_probs = np.zeros([X.shape[0], K], dtype=float)
+        # The per-component work releases the GIL (BLAS / nogil numba kernel), so the threads share X without copies
+        self._prepare_component_cache()
+        invD = np.power(self.D, -1.0)
+        num_workers = min(K, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            comp_results = executor.map(lambda k: MFA._get_component_log_probs_task(
+                self.mu[k], self.W[k], invD[k], self.pi_c_factor[k], X, self.backend == 'numba'), range(K))
+            for comp_num, comp_ll in enumerate(comp_results):
+                components_log_probs[:, comp_num] = comp_ll
         print('_get_components_log_probabilities - multhreaded end')
         return components_log_probs
 
-
     def _get_components_log_probabilities(self, samples):
-        X = self._rearrange_input(samples)
-        components_log_probs = np.zeros([X.shape[0], len(self.components)], dtype=float)
-        for k, c in self.components.items():
-            components_log_probs[:, k] = np.log(c['pi']) + self._get_component_log_probs(X, k)
-        return components_log_probs
+        X = np.ascontiguousarray(self._rearrange_input(samples), dtype=self.dtype)
+        p = self._prepare_batched_params()
+        N = X.shape[0]
+        K, l = self.W.shape[:2]
+
+        if self.backend == 'cupy':
+            return self._get_components_log_probabilities_cupy(X, p, self.pi_c_factor)
+
+        if self.backend == 'numba':
+            _import_numba()
+            # Fused kernel - all the components are evaluated while a row of X is in cache, without X - mu copies
+            # (specialized code for the common small l)
+            m_d = np.empty([N, K])
+            kernel = _get_specialized_mixture_kernel(l) if l <= _MAX_SPECIALIZED_L else _mixture_mahalanobis_kernel
+            kernel(X, self.mu, p['W'], p['invD'], m_d)
+            return -0.5 * (m_d + self.pi_c_factor)
+
+        # Process X in blocks of rows, so that all the products of a block are done while it is still in cache.
+        # The BLAS gemm is called directly to write into block-sized work buffers: C-contiguous [n, m] outputs are passed
+        # as their (Fortran-contiguous) transposes and computed as out.T = B.T @ X_b.T, so nothing is copied.
+        # The buffers are allocated per call, so that concurrent calls on the same model do not share them.
+        # A float32 X is converted to float64 one block at a time, while the block is in cache.
+        gemm = scipy.linalg.blas.get_blas_funcs('gemm', dtype=float)
+        m_d = np.empty([N, K])
+        Z_buffer = np.empty([self.block_size, K*l])
+        X_sqr_buffer = np.empty([self.block_size, X.shape[1]])
+        X_buffer = np.empty([self.block_size, X.shape[1]]) if X.dtype != float else None
+        for i0 in range(0, N, self.block_size):
+            X_b = X[i0:i0+self.block_size]
+            n = X_b.shape[0]
+            if X_buffer is not None:
+                X_buffer[:n] = X_b
+                X_b = X_buffer[:n]
+            # A single [n, d] x [d, K*l] GEMM for all components, mu is subtracted by pre-filling the output
+            Z = Z_buffer[:n]
+            Z[:] = -p['mu_W']
+            gemm(1.0, p['W'].T, X_b.T, beta=1.0, c=Z.T, overwrite_c=True)
+            # (x-mu)' @ invD @ (x-mu) = x' @ invD @ x - 2 * x' @ (mu * invD) + mu' @ invD @ mu - no X - mu copies
+            X_sqr = np.multiply(X_b, X_b, out=X_sqr_buffer[:n])
+            m_d_b = m_d[i0:i0+n]
+            gemm(1.0, p['invD'].T, X_sqr.T, c=m_d_b.T, trans_a=1, overwrite_c=True)
+            gemm(-2.0, p['mu_invD'].T, X_b.T, beta=1.0, c=m_d_b.T, trans_a=1, overwrite_c=True)
+            Z = Z.reshape([n, K, l])
+            m_d_b -= np.einsum('nkl,nkl->nk', Z, Z)
+        m_d += p['mu_invD_mu']
+        return -0.5 * (m_d + self.pi_c_factor)
+
+    @staticmethod
+    def _get_components_log_probabilities_cupy(X, p, c_factor):
+        """
+        The batched (NumPy path) computation on the GPU - X is uploaded once, only the [N, K] result is copied back
+        X is uploaded as is (e.g. float32) and converted to float64 on the device
+        """
+        N = X.shape[0]
+        K = c_factor.size
+        g = p['device']
+        X_g = cupy.asarray(X).astype(float, copy=False)
+        Z = (X_g @ g['W'] - g['mu_W']).reshape([N, K, -1])
+        m_d = (X_g * X_g) @ g['invD'].T - 2.0 * (X_g @ g['mu_invD'].T) - cupy.einsum('nkl,nkl->nk', Z, Z)
+        m_d = cupy.asnumpy(m_d) + p['mu_invD_mu']
+        return -0.5 * (m_d + c_factor)
 
     def _get_components_log_probabilities_debug(self, samples):
         X = self._rearrange_input(samples)
-        components_log_probs = np.zeros([X.shape[0], len(self.components)], dtype=float)
-        for k, c in self.components.items():
+        components_log_probs = np.zeros([X.shape[0], self.pi.size], dtype=float)
+        for k in range(self.pi.size):
             components_log_probs[:, k] = self._get_component_log_probs(X, k)
         return components_log_probs
 
@@ -242,16 +658,19 @@ class MFA:
     #     return c['A'] @ z + c['mu']
 
     def plot_components(self, num_samples=None, figure_num=1, subplot=111, title=None):
+        # matplotlib is imported only when plotting, to keep the module import light (e.g. in worker processes)
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D
         fig = plt.figure(figure_num)
-        if self.components[0]['mu'].size < 3:
+        if self.mu.shape[1] < 3:
             ax = fig.add_subplot(subplot)
         else:
             ax = fig.add_subplot(subplot, projection='3d')
         plt.cla()
         if not num_samples:
-            num_samples = 1000 * len(self.components)
+            num_samples = 1000 * self.pi.size
         for c in self.components.values():
-            P = MFA._draw_from_component(int(c['pi'] * num_samples), c)
+            P = MFA._draw_from_component(int(c['pi'] * num_samples), c, rng=self.rng)
             if P.shape[1] == 2:
                 ax.plot(P[:,0], P[:,1], '.', alpha=0.3)
                 plt.axis([-1.2, 1.2, -1.2, 1.2])
@@ -268,14 +687,16 @@ class MFA:
         if not component_nums:
             # Find most probable component for each sample
             component_nums = np.argmax(self.get_responsibilities(samples), axis=1)
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D
         fig = plt.figure(figure_num)
-        if self.components[0]['mu'].size < 3:
+        if self.mu.shape[1] < 3:
             ax = fig.add_subplot(subplot)
         else:
             ax = fig.add_subplot(subplot, projection='3d')
         plt.cla()
         component_nums = np.array(component_nums)
-        for c in self.components.keys():
+        for c in range(self.pi.size):
             if samples.shape[1] == 2:
                 ax.plot(samples[component_nums == c, 0], samples[component_nums == c, 1], '.', alpha=0.3)
                 plt.axis([-1.2, 1.2, -1.2, 1.2])
@@ -290,16 +711,24 @@ class MFA:
         plt.grid(True)
 
     def save(self, file_name):
-        with open(file_name+'.pkl', 'wb') as f:
-            pickle.dump(self.components, f, pickle.HIGHEST_PROTOCOL)
+        np.savez(file_name+'.npz', A=self.A, D=self.D, mu=self.mu, pi=self.pi)
 
     def load(self, file_name):
-        full_name = file_name if file_name.endswith('.pkl') else file_name+'.pkl'
-        with open(full_name, 'rb') as f:
-            self.components = pickle.load(f)
+        """
+        Load a model saved by save() (.npz), or a legacy pickled dict of components (.pkl)
+        """
+        base_name = file_name[:-4] if file_name.endswith(('.npz', '.pkl')) else file_name
+        if not file_name.endswith('.pkl') and os.path.isfile(base_name+'.npz'):
+            with np.load(base_name+'.npz') as params:
+                self.set_params(params['A'], params['D'], params['mu'], params['pi'])
+        else:
+            with open(base_name+'.pkl', 'rb') as f:
+                self.components = pickle.load(f)
+        self._prepare_component_cache()
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
     try_gmm = MFA()
     print('randomizing...')
     try_gmm.randomize_params(3, 500, low_rank_scale=0.2, noise_variance=0.01, mu_range=0.2)